@@ -1,53 +1,637 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import functools
+import hashlib
+import ijson
 import json
 import os
+import time
 import click
-import plotly.express as px
-from better_profanity import profanity
+import diskcache
+import msgspec
 from dotenv import load_dotenv
-import openai
-from collections import Counter
-from typing import List, Dict, Any
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+from itertools import accumulate, islice
+from typing import List, Dict, Any, Iterable, Iterator, Callable, Awaitable, MutableMapping, Optional, BinaryIO, Tuple, Annotated, Literal, TYPE_CHECKING, get_args
+
+# Heavy modules are imported where they are first needed, keeping CLI startup fast
+if TYPE_CHECKING:
+    import numpy as np
+    import openai
+    import tiktoken
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the standard library
+    orjson = None
 
 # Load environment variables
 load_dotenv()
 
 # Configure OpenAI
-openai.api_key = os.getenv("OPENAI_API_KEY")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+MODEL = "gpt-4o-mini"
+BATCH_POLL_INTERVAL = 30  # seconds between Batch API status checks
+EXPECTED_OUTPUT_TOKENS_PER_COMMENT = 60  # rough size of one result entry, used for rate limiting
+RATE_LIMIT_COOLDOWN = 15  # seconds all sync requests pause after a rate limit error without Retry-After
+STREAM_CHUNK_SIZE = 1000  # minimum number of comments read from the input and analyzed at a time in sync mode
+PREFILTER_MAX_WORDS = 12  # clean comments shorter than this skip OpenAI with --prefilter profanity-skip-clean
+
+SYSTEM_PROMPT = (
+    "You are a content moderation assistant. You will receive a numbered list of comments. "
+    "Analyze each comment and report the results with the report_moderation function, one entry per comment. "
+    "Each entry contains: index (the number of the comment), is_offensive (true/false), offense_type (if applicable: "
+    "hate_speech, toxicity, profanity, harassment, or none), severity (1-5 where 1 is least severe and 5 is most severe), "
+    "and a brief explanation."
+)
+
+# Offense types the model can report, plus "error" for comments that could not be analyzed
+OffenseType = Literal["hate_speech", "toxicity", "profanity", "harassment", "none", "error"]
+OFFENSE_TYPES = get_args(OffenseType)
+# Small integer ids standing in for offense types in the aggregation arrays
+OFFENSE_TYPE_IDS = {offense_type: idx for idx, offense_type in enumerate(OFFENSE_TYPES)}
+
+# Function the model is forced to call, so its output always follows the BatchAnalysis schema
+REPORT_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "report_moderation",
+        "description": "Report the moderation verdict for every comment.",
+        "strict": True,
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "results": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "index": {"type": "integer"},
+                            "is_offensive": {"type": "boolean"},
+                            "offense_type": {
+                                "type": "string",
+                                "enum": [t for t in OFFENSE_TYPES if t != "error"]
+                            },
+                            "severity": {"type": "integer", "enum": [1, 2, 3, 4, 5]},
+                            "explanation": {"type": "string"}
+                        },
+                        "required": ["index", "is_offensive", "offense_type", "severity", "explanation"],
+                        "additionalProperties": False
+                    }
+                }
+            },
+            "required": ["results"],
+            "additionalProperties": False
+        }
+    }
+}
+
+def json_loads(data: Any) -> Any:
+    """Decode JSON from str or bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(obj: Any, indent: bool = False) -> bytes:
+    """Encode an object as UTF-8 JSON, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode()
+
+class Analysis(msgspec.Struct):
+    """Moderation verdict for a single comment."""
+    is_offensive: bool
+    offense_type: OffenseType
+    severity: Annotated[int, msgspec.Meta(ge=1, le=5)]
+    explanation: str
+
+class IndexedAnalysis(Analysis):
+    """Verdict for one comment of a batch, numbered as in the request."""
+    index: int
+
+class BatchAnalysis(msgspec.Struct):
+    """Structured content of a batched ChatCompletion response."""
+    results: List[IndexedAnalysis]
+
+def load_comments(file_path: str) -> Iterator[Dict[str, Any]]:
+    """Stream comments from JSON file one at a time."""
+    with open(file_path, 'rb') as f:
+        yield from ijson.items(f, 'comments.item', use_float=True)
+
+def chunks(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """Split an iterable into consecutive chunks of at most size items."""
+    iterator = iter(items)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+def error_analysis() -> Analysis:
+    """Analysis used for comments that could not be analyzed."""
+    return Analysis(is_offensive=False, offense_type="error", severity=1, explanation="Error in analysis")
+
+def substitution_table(char_map: Dict[str, Any]) -> Dict[int, str]:
+    """Translation table sending each character to one representative of all characters it may stand in for."""
+    groups = []
+    for char, substitutes in char_map.items():
+        group = {char, *substitutes}
+        for other in [g for g in groups if g & group]:
+            group |= other
+            groups.remove(other)
+        groups.append(group)
+    return str.maketrans({char: min(group) for group in groups for char in group})
+
+def build_profanity_checker() -> Callable[[str], bool]:
+    """Compile the better_profanity word list into a single Aho-Corasick automaton and return a checker using it."""
+    import re
+    import ahocorasick
+    from better_profanity import profanity
+    from better_profanity.constants import ALLOWED_CHARACTERS
+    
+    substitutions = substitution_table(profanity.CHARS_MAPPING)
+    profanity.load_censor_words()
+    automaton = ahocorasick.Automaton()
+    for word in profanity.CENSOR_WORDSET:
+        original = str(word)
+        # better_profanity only compares runs of whole words, so entries starting or ending in punctuation never match
+        if original[0] not in ALLOWED_CHARACTERS or original[-1] not in ALLOWED_CHARACTERS:
+            continue
+        # Words are keyed by their substitution-insensitive form, so that "f*ck" and "fuck" share a key
+        key = original.translate(substitutions)
+        length, words = automaton.get(key, (len(key), []))
+        automaton.add_word(key, (length, words + [word]))
+    automaton.make_automaton()
+    
+    word_pattern = re.compile('[' + ''.join(map(re.escape, sorted(ALLOWED_CHARACTERS))) + ']+')
+    max_words = profanity.MAX_NUMBER_COMBINATIONS + 1
+    
+    def find_words(haystack: str, starts: List[int], ends: List[int], joinable: int) -> bool:
+        """Whether a censored word spans up to max_words whole words of haystack, given where each word starts and ends.
+        
+        Only the first joinable words may take part in a match spanning several words.
+        """
+        first_word = {start: idx for idx, start in enumerate(starts)}
+        last_word = {end - 1: idx for idx, end in enumerate(ends)}
+        for end, (length, words) in automaton.iter(haystack.translate(substitutions)):
+            start = end - length + 1
+            if start not in first_word or end not in last_word:
+                continue
+            first, last = first_word[start], last_word[end]
+            if last - first >= max_words or (last > first and last >= joinable):
+                continue
+            # The key only narrows down candidates; confirm the exact spelling variant
+            if any(word == haystack[start:end + 1] for word in words):
+                return True
+        return False
+    
+    def contains_profanity(text: str) -> bool:
+        """Check text for censored words with the same word splitting and substitutions as better_profanity.
+        
+        Like better_profanity, consecutive words match both as written and joined together, so "s.h.i.t" is caught.
+        """
+        lowered = text.lower()
+        spans = [match.span() for match in word_pattern.finditer(lowered)]
+        if not spans:
+            return False
+        starts, ends = [start for start, _ in spans], [end for _, end in spans]
+        # better_profanity never joins a one-character word at the very end of the text to the words before it
+        joinable = len(spans) - (starts[-1] == len(lowered) - 1)
+        if find_words(lowered, starts, ends, joinable):
+            return True
+        # Same words with the characters between them left out
+        joined_ends = list(accumulate(end - start for start, end in spans))
+        joined_starts = [0] + joined_ends[:-1]
+        return find_words(''.join(lowered[start:end] for start, end in spans), joined_starts, joined_ends, joinable)
+    
+    return contains_profanity
+
+def prefiltered_analysis() -> Analysis:
+    """Analysis used for comments the profanity pre-filter considers clean."""
+    return Analysis(is_offensive=False, offense_type="none", severity=1, explanation="pre-filtered clean")
 
-def load_comments(file_path: str) -> List[Dict[str, Any]]:
-    """Load comments from JSON file."""
-    with open(file_path, 'r') as f:
-        data = json.load(f)
-    return data['comments']
+def needs_analysis(comment: Dict[str, Any], prefilter: str) -> bool:
+    """Whether a comment has to be sent to OpenAI under the given pre-filter mode."""
+    if prefilter == 'none' or comment['contains_profanity']:
+        return True
+    if prefilter == 'profanity-skip-clean':
+        # Longer comments can be offensive without profanity, so OpenAI still decides those
+        return len(comment['comment_text'].split()) >= PREFILTER_MAX_WORDS
+    return False
 
-def analyze_comment(comment_text: str) -> Dict[str, Any]:
-    """Analyze a comment using OpenAI's API."""
+def build_request_body(comment_texts: List[str]) -> Dict[str, Any]:
+    """Build the ChatCompletion request body analyzing a batch of comments."""
+    # Comments are JSON-encoded so that embedded newlines cannot break the numbering
+    numbered = "\n".join(f"{idx}. {json_dumps(text).decode()}" for idx, text in enumerate(comment_texts, 1))
+    return {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"Comments:\n{numbered}"}
+        ],
+        "temperature": 0.3,
+        "tools": [REPORT_TOOL],
+        "tool_choice": {"type": "function", "function": {"name": REPORT_TOOL['function']['name']}}
+    }
+
+def parse_batch_results(completion: Dict[str, Any], count: int) -> List[Analysis]:
+    """Validate the results of a ChatCompletion response and scatter them back into comment order."""
+    arguments = completion['choices'][0]['message']['tool_calls'][0]['function']['arguments']
+    results = msgspec.json.decode(arguments, type=BatchAnalysis).results
+    
+    # Anything missing from the response counts as an error
+    analyses: List[Optional[Analysis]] = [None] * count
+    for result in results:
+        idx = result.index
+        if 1 <= idx <= count and analyses[idx - 1] is None:
+            analyses[idx - 1] = Analysis(result.is_offensive, result.offense_type, result.severity, result.explanation)
+    return [analysis if analysis is not None else error_analysis() for analysis in analyses]
+
+@functools.lru_cache(maxsize=None)
+def get_encoding() -> Optional[tiktoken.Encoding]:
+    """Tokenizer for MODEL, loaded once on first use; None if it cannot be loaded."""
+    import tiktoken
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a content moderation assistant. Analyze the comment and respond with a JSON containing: is_offensive (true/false), offense_type (if applicable: hate_speech, toxicity, profanity, harassment, or none), severity (1-5 where 1 is least severe and 5 is most severe), and a brief explanation."},
-                {"role": "user", "content": comment_text}
-            ],
-            temperature=0.3
+        return tiktoken.encoding_for_model(MODEL)
+    except Exception as e:
+        # The encoding is downloaded on first use, which fails offline; remember the failure instead of retrying
+        print(f"Could not load tokenizer, estimating tokens from text length: {e}")
+        return None
+
+def count_tokens(text: str) -> int:
+    """Number of tokens in text, or a rough estimate from its length without a tokenizer."""
+    encoding = get_encoding()
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text))
+
+@functools.lru_cache(maxsize=None)
+def fixed_prompt_tokens() -> int:
+    """Tokens taken by the system message and tool definition, which are the same for every request."""
+    return count_tokens(SYSTEM_PROMPT) + 4 + count_tokens(json_dumps(REPORT_TOOL).decode())
+
+def estimate_tokens(request_body: Dict[str, Any], comment_count: int) -> int:
+    """Estimate the tokens a ChatCompletion request will consume, prompt and completion combined."""
+    # Every message carries a few tokens of framing on top of its content
+    user_tokens = sum(count_tokens(message['content']) + 4 for message in request_body['messages'][1:])
+    prompt_tokens = fixed_prompt_tokens() + user_tokens + 2
+    return prompt_tokens + comment_count * EXPECTED_OUTPUT_TOKENS_PER_COMMENT
+
+class RateLimiter:
+    """Token bucket keeping requests under per-minute request and token budgets."""
+    
+    def __init__(self, max_requests_per_minute: float, max_tokens_per_minute: float):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_requests = max_requests_per_minute
+        self.available_tokens = max_tokens_per_minute
+        self.last_update = time.monotonic()
+        self.resume_at = 0.0
+        self.lock = asyncio.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed_minutes = (now - self.last_update) / 60
+        self.available_requests = min(
+            self.max_requests_per_minute,
+            self.available_requests + elapsed_minutes * self.max_requests_per_minute
         )
-        
-        result = json.loads(response.choices[0].message.content)
-        return result
+        self.available_tokens = min(
+            self.max_tokens_per_minute,
+            self.available_tokens + elapsed_minutes * self.max_tokens_per_minute
+        )
+        self.last_update = now
+    
+    def cool_down(self, seconds: float):
+        """Hold back all requests for the given time, e.g. after the server reported a rate limit error."""
+        self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+    
+    async def acquire(self, tokens: int):
+        """Wait until there is capacity for one request of the given size, then consume it."""
+        # A request larger than the whole budget would otherwise wait forever
+        tokens = min(tokens, self.max_tokens_per_minute)
+        async with self.lock:
+            while True:
+                pause = self.resume_at - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                await asyncio.sleep(60 * max(
+                    (1 - self.available_requests) / self.max_requests_per_minute,
+                    (tokens - self.available_tokens) / self.max_tokens_per_minute
+                ))
+
+def is_retryable(exc: BaseException) -> bool:
+    """Whether a failed OpenAI request is transient (rate limit, server error or network) and worth retrying."""
+    import openai
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code == 429 or exc.status_code >= 500
+    return isinstance(exc, openai.APIConnectionError)
+
+_backoff = wait_exponential_jitter(initial=1, max=60)
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """Seconds the server's Retry-After header asks to wait before trying again, if it sent one."""
+    response = getattr(exc, 'response', None)
+    headers = response.headers if response is not None else {}
+    try:
+        return min(float(headers.get('Retry-After')), 60)
+    except (TypeError, ValueError):
+        return None
+
+def wait_for_retry(retry_state) -> float:
+    """Wait as long as the server's Retry-After header asks, else back off exponentially with jitter."""
+    wait = retry_after(retry_state.outcome.exception())
+    return wait if wait is not None else _backoff(retry_state)
+
+openai_retry = retry(
+    retry=retry_if_exception(is_retryable),
+    stop=stop_after_attempt(5),
+    wait=wait_for_retry,
+    reraise=True
+)
+
+@functools.lru_cache(maxsize=None)
+def get_client() -> openai.AsyncOpenAI:
+    """OpenAI client shared by all requests, reusing pooled HTTP/2 connections."""
+    import httpx
+    import openai
+    return openai.AsyncOpenAI(
+        api_key=OPENAI_API_KEY,
+        max_retries=0,  # retries are handled by openai_retry
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=100)
+        )
+    )
+
+async def close_client():
+    """Close the shared client's connection pool, if it was opened, while its event loop is still running."""
+    if get_client.cache_info().currsize:
+        await get_client().close()
+        get_client.cache_clear()
+
+@openai_retry
+async def call_openai(method: Callable[..., Awaitable[Any]], **kwargs) -> Any:
+    """Call an OpenAI client method, retrying transient failures."""
+    return await method(**kwargs)
+
+@openai_retry
+async def call_openai_limited(limiter: RateLimiter, tokens: int, method: Callable[..., Awaitable[Any]], **kwargs) -> Any:
+    """Call an OpenAI client method within the rate limits, retrying transient failures.
+    
+    Every attempt takes its share of the budget, and a rate limit error pauses all requests sharing the limiter.
+    """
+    import openai
+    await limiter.acquire(tokens)
+    try:
+        return await method(**kwargs)
+    except openai.RateLimitError as e:
+        wait = retry_after(e)
+        limiter.cool_down(wait if wait is not None else RATE_LIMIT_COOLDOWN)
+        raise
+
+async def analyze_comment_batch(sem: asyncio.Semaphore, limiter: RateLimiter, comment_texts: List[str]) -> List[Analysis]:
+    """Analyze several comments with a single OpenAI request."""
+    request_body = build_request_body(comment_texts)
+    # Only a throttling heuristic, so it is kept out of the error handling for the request itself
+    tokens = estimate_tokens(request_body, len(comment_texts))
+    try:
+        async with sem:
+            completion = await call_openai_limited(limiter, tokens, get_client().chat.completions.create, **request_body)
+        return parse_batch_results(completion.model_dump(), len(comment_texts))
     except Exception as e:
-        print(f"Error analyzing comment: {e}")
-        return {
-            "is_offensive": False,
-            "offense_type": "error",
-            "severity": 1,
-            "explanation": "Error in analysis"
-        }
+        print(f"Error analyzing batch of {len(comment_texts)} comments: {e}")
+        return [error_analysis() for _ in comment_texts]
+
+async def gather_all(sem: asyncio.Semaphore, limiter: RateLimiter, comment_texts: List[str], batch_size: int) -> List[Analysis]:
+    """Analyze all comments in concurrent batches."""
+    batches = await asyncio.gather(
+        *[analyze_comment_batch(sem, limiter, chunk) for chunk in chunks(comment_texts, batch_size)]
+    )
+    return [analysis for batch in batches for analysis in batch]
+
+async def run_batch_job(comment_texts: List[str], batch_size: int) -> List[Analysis]:
+    """Analyze all comments through the OpenAI Batch API and wait for the job to finish."""
+    text_chunks = list(chunks(comment_texts, batch_size))
+    requests = [
+        json_dumps({
+            "custom_id": f"chunk-{idx}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": build_request_body(chunk)
+        })
+        for idx, chunk in enumerate(text_chunks)
+    ]
+    
+    # Upload the requests and submit the batch
+    client = get_client()
+    input_file = await call_openai(
+        client.files.create,
+        file=('comments_batch.jsonl', b"\n".join(requests)),
+        purpose='batch'
+    )
+    batch = await call_openai(
+        client.batches.create,
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    print(f"Submitted batch {batch.id} with {len(requests)} requests")
+    
+    # Poll until the batch reaches a terminal state
+    while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+        await asyncio.sleep(BATCH_POLL_INTERVAL)
+        batch = await call_openai(client.batches.retrieve, batch_id=batch.id)
+        print(f"Batch status: {batch.status}")
+    
+    # Errors of the job as a whole, e.g. an input file that failed validation
+    if batch.status != 'completed':
+        print(f"Batch {batch.id} ended with status {batch.status}")
+    for error in (batch.errors.data or []) if batch.errors else []:
+        print(f"Batch error {error.code} at line {error.line}: {error.message}")
+    
+    # Successful requests land in the output file, failed ones in the error file
+    output = ""
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if file_id:
+            output += (await call_openai(client.files.content, file_id=file_id)).text + "\n"
+    
+    # Join results back by custom_id; failed or missing requests count as errors
+    analyses = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        record = json_loads(line)
+        idx = int(record['custom_id'].split('-', 1)[1])
+        response = record.get('response') or {}
+        try:
+            if response.get('status_code') != 200:
+                body_error = (response.get('body') or {}).get('error') or {}
+                raise ValueError(
+                    record.get('error') or body_error.get('message') or f"status code {response.get('status_code')}"
+                )
+            analyses[idx] = parse_batch_results(response['body'], len(text_chunks[idx]))
+        except Exception as e:
+            print(f"Error analyzing batch of {len(text_chunks[idx])} comments: {e}")
+            analyses[idx] = [error_analysis() for _ in text_chunks[idx]]
+    
+    missing = [chunk for idx, chunk in enumerate(text_chunks) if idx not in analyses]
+    if missing:
+        print(f"No result for {len(missing)} requests ({sum(map(len, missing))} comments)")
+    
+    return [
+        analysis
+        for idx, chunk in enumerate(text_chunks)
+        for analysis in analyses.get(idx, [error_analysis() for _ in chunk])
+    ]
+
+@functools.lru_cache(maxsize=None)
+def prompt_hash() -> str:
+    """Hash of everything a request sends besides the comments: model, system prompt, tool and sampling settings."""
+    return hashlib.sha256(json_dumps(build_request_body([]))).hexdigest()[:16]
+
+def comment_key(comment_text: str) -> str:
+    """Cache key identifying a comment by the hash of its text, scoped to the model and prompt analyzing it.
+    
+    Changing either starts from an empty cache instead of serving verdicts produced under the old settings.
+    """
+    return f"{MODEL}:{prompt_hash()}:{hashlib.sha256(comment_text.encode()).hexdigest()}"
+
+async def analyze_with_cache(comment_texts: List[str], cache: MutableMapping[str, Any], analyze: Callable[[List[str]], Awaitable[List[Analysis]]]) -> List[Analysis]:
+    """Analyze each distinct comment text once, answering repeats and cached texts locally."""
+    keys = [comment_key(text) for text in comment_texts]
+    analyses = {}
+    missing = {}
+    for key, text in zip(keys, comment_texts):
+        if key in analyses or key in missing:
+            continue
+        try:
+            analyses[key] = msgspec.convert(cache[key], Analysis)
+        except (KeyError, msgspec.ValidationError):
+            # Not cached yet, or cached in a shape that no longer validates
+            missing[key] = text
+    
+    if missing:
+        print(f"Sending {len(missing)} uncached comments to OpenAI")
+        for key, analysis in zip(missing, await analyze(list(missing.values()))):
+            analyses[key] = analysis
+            # Failures are not cached so that the next run tries them again
+            if analysis.offense_type != 'error':
+                cache[key] = msgspec.to_builtins(analysis)
+    
+    return [analyses[key] for key in keys]
+
+async def drain(queue: asyncio.Queue, out_fp: BinaryIO, filter_offensive: bool):
+    """Append analyzed comments from the queue to a JSON Lines file until None is received."""
+    while (comments := await queue.get()) is not None:
+        lines = b"".join(
+            json_dumps(c) + b"\n" for c in comments if c['is_offensive'] or not filter_offensive
+        )
+        # Write off the event loop so that analysis of the next chunk carries on meanwhile
+        await asyncio.to_thread(out_fp.write, lines)
+
+async def moderate_comments(comment_chunks: Iterable[List[Dict[str, Any]]], contains_profanity: Callable[[str], bool], cache: MutableMapping[str, Any], prefilter: str, mode: str, max_concurrent: int, batch_size: int, max_requests_per_minute: int, max_tokens_per_minute: int, stream_file: Optional[BinaryIO] = None, filter_offensive: bool = False, keep_comments: bool = True) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], Dict[str, List[Any]]]:
+    """Pre-filter and analyze comments chunk by chunk.
+    
+    Returns the analyzed comments (only if keep_comments is set, else an empty list), the offensive ones among
+    them, and the analysis fields of all comments gathered into columns for aggregation.
+    If stream_file is given, each analyzed chunk is also written to it as JSON Lines in the background.
+    """
+    sem = asyncio.Semaphore(max_concurrent)
+    limiter = RateLimiter(max_requests_per_minute, max_tokens_per_minute)
+    comments = []
+    offensive = []
+    columns = {'is_offensive': [], 'severity': [], 'offense_type': []}
+    skipped = 0
+    queue = asyncio.Queue()
+    writer = asyncio.create_task(drain(queue, stream_file, filter_offensive)) if stream_file else None
+    
+    async def analyze(comment_texts: List[str]) -> List[Analysis]:
+        if mode == 'batch':
+            return await run_batch_job(comment_texts, batch_size)
+        return await gather_all(sem, limiter, comment_texts, batch_size)
+    
+    async def analyze_chunk(chunk: List[Dict[str, Any]]) -> List[Analysis]:
+        nonlocal skipped
+        for comment in chunk:
+            # Pre-filter with profanity check
+            comment['contains_profanity'] = contains_profanity(comment['comment_text'])
+        selected = [needs_analysis(comment, prefilter) for comment in chunk]
+        to_analyze = [comment['comment_text'] for comment, send in zip(chunk, selected) if send]
+        skipped += len(chunk) - len(to_analyze)
+        
+        # Analyze with OpenAI
+        analyses = iter(await analyze_with_cache(to_analyze, cache, analyze))
+        return [next(analyses) if send else prefiltered_analysis() for send in selected]
+    
+    async def collect(chunk: List[Dict[str, Any]], task: asyncio.Task):
+        for comment, analysis in zip(chunk, await task):
+            columns['is_offensive'].append(analysis.is_offensive)
+            columns['severity'].append(analysis.severity)
+            columns['offense_type'].append(OFFENSE_TYPE_IDS[analysis.offense_type])
+            # Comments stay plain dicts for export
+            comment.update(msgspec.to_builtins(analysis))
+            if analysis.is_offensive:
+                offensive.append(comment)
+        # Other comments are dropped once written, so memory does not grow with the input
+        if keep_comments:
+            comments.extend(chunk)
+        if writer:
+            await queue.put(chunk)
+        print(f"Analyzed {len(columns['is_offensive'])} comments")
+    
+    # The next chunk is already being analyzed while the current one finishes, so requests keep flowing across
+    # chunk boundaries and a batch stuck in backoff does not stall the next chunk; at most two chunks are held
+    pending = []
+    try:
+        for chunk in comment_chunks:
+            pending.append((chunk, asyncio.create_task(analyze_chunk(chunk))))
+            if len(pending) > 1:
+                await collect(*pending.pop(0))
+        while pending:
+            await collect(*pending.pop(0))
+    finally:
+        # Stop analysis still in flight if the run was interrupted
+        for _, task in pending:
+            task.cancel()
+        await asyncio.gather(*(task for _, task in pending), return_exceptions=True)
+        # Flush whatever was analyzed, so an interrupted run still leaves partial results on disk
+        if writer:
+            await queue.put(None)
+            await writer
+        await close_client()
+    
+    if prefilter != 'none':
+        print(f"Pre-filter skipped {skipped} clean comments")
+    return comments, offensive, columns
 
-def plot_offense_distribution(offense_types: Dict[str, int], output_file: str):
+def plot_offense_distribution(offense_counts: Dict[str, int], output_file: str, plot_format: str = 'html'):
     """Create a bar chart showing offense type distribution."""
+    offense_types, counts = list(offense_counts), list(offense_counts.values())
+    
+    if plot_format == 'png':
+        # Static images are drawn with matplotlib, which is much lighter than Plotly
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=(8, 6))
+        ax = fig.subplots()
+        ax.bar(offense_types, counts)
+        ax.set_xlabel('Offense Type')
+        ax.set_ylabel('Number of Comments')
+        ax.set_title('Distribution of Offense Types')
+        ax.tick_params(axis='x', labelrotation=45)
+        fig.tight_layout()
+        fig.savefig(output_file, dpi=100)
+        return
+    
+    import plotly.express as px
     fig = px.bar(
-        x=list(offense_types.keys()),
-        y=list(offense_types.values()),
+        x=offense_types,
+        y=counts,
         labels={'x': 'Offense Type', 'y': 'Number of Comments'},
         title='Distribution of Offense Types'
     )
@@ -58,13 +642,24 @@ def plot_offense_distribution(offense_types: Dict[str, int], output_file: str):
     )
     fig.write_html(output_file)
 
-def plot_severity_distribution(comments: List[Dict[str, Any]], output_file: str):
+def plot_severity_distribution(severity_counts: Dict[int, int], output_file: str, plot_format: str = 'html'):
     """Create a pie chart showing severity distribution."""
-    severity_counts = Counter(c.get('severity', 1) for c in comments if c['is_offensive'])
+    names = [f"Severity {k}" for k in severity_counts]
+    counts = list(severity_counts.values())
     
+    if plot_format == 'png':
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=(8, 6))
+        ax = fig.subplots()
+        ax.pie(counts, labels=names, autopct='%1.1f%%')
+        ax.set_title('Severity Distribution of Offensive Comments')
+        fig.savefig(output_file, dpi=100)
+        return
+    
+    import plotly.express as px
     fig = px.pie(
-        names=[f"Severity {k}" for k in severity_counts.keys()],
-        values=list(severity_counts.values()),
+        names=names,
+        values=counts,
         title='Severity Distribution of Offensive Comments'
     )
     fig.update_traces(textposition='inside', textinfo='percent+label')
@@ -74,85 +669,129 @@ def plot_severity_distribution(comments: List[Dict[str, Any]], output_file: str)
     )
     fig.write_html(output_file)
 
-def generate_report(analyzed_comments: List[Dict[str, Any]]) -> Dict[str, Any]:
+def column_arrays(columns: Dict[str, List[Any]]) -> Dict[str, np.ndarray]:
+    """Convert analysis columns into NumPy arrays for vectorized aggregation."""
+    import numpy as np
+    return {
+        'is_offensive': np.asarray(columns['is_offensive'], dtype=bool),
+        'severity': np.asarray(columns['severity'], dtype=np.int8),
+        'offense_type': np.asarray(columns['offense_type'], dtype=np.int8)
+    }
+
+def first_seen_order(values: np.ndarray, counts: np.ndarray) -> List[int]:
+    """Values with a non-zero count, in order of their first appearance in values."""
+    import numpy as np
+    return sorted(np.flatnonzero(counts), key=lambda value: np.argmax(values == value))
+
+def generate_report(arrays: Dict[str, np.ndarray], offensive: List[Dict[str, Any]]) -> Dict[str, Any]:
     """Generate a summary report of the analysis."""
-    total_comments = len(analyzed_comments)
-    offensive_comments = sum(1 for c in analyzed_comments if c['is_offensive'])
-    offense_types = Counter(c['offense_type'] for c in analyzed_comments if c['is_offensive'])
+    import numpy as np
+    is_offensive = arrays['is_offensive']
+    type_ids = arrays['offense_type'][is_offensive]
+    severity = arrays['severity'][is_offensive]
     
-    # Sort comments by severity (most severe first)
-    most_offensive = sorted(
-        [c for c in analyzed_comments if c['is_offensive']],
-        key=lambda x: x.get('severity', 1),
-        reverse=True
-    )[:5]
+    # Offense types and severities are small integers, so each histogram is a single bincount;
+    # both are listed in order of first appearance
+    type_counts = np.bincount(type_ids, minlength=len(OFFENSE_TYPES))
+    severity_counts = np.bincount(severity, minlength=6)
+    offense_types = {OFFENSE_TYPES[t]: int(type_counts[t]) for t in first_seen_order(type_ids, type_counts)}
+    severities = {int(level): int(severity_counts[level]) for level in first_seen_order(severity, severity_counts)}
     
-    # Get all offensive comments
-    all_offensive = [c for c in analyzed_comments if c['is_offensive']]
+    # Most severe comments first, in input order among equal severities; severities only run from 5 down to 1,
+    # so collecting them level by level avoids sorting every offensive comment
+    top = []
+    for level in range(5, 0, -1):
+        if len(top) == 5:
+            break
+        top.extend(np.flatnonzero(severity == level)[:5 - len(top)])
     
     return {
-        'total_comments': total_comments,
-        'offensive_comments': offensive_comments,
-        'offense_types': dict(offense_types),
-        'most_offensive': most_offensive,
-        'all_offensive': all_offensive
+        'total_comments': len(is_offensive),
+        'offensive_comments': len(offensive),
+        'offense_types': offense_types,
+        'severity_counts': severities,
+        'most_offensive': [offensive[i] for i in top],
+        'all_offensive': offensive
     }
 
 def export_to_json(analyzed_comments: List[Dict[str, Any]], output_file: str):
     """Export analyzed comments to JSON."""
-    with open(output_file, 'w') as f:
-        json.dump(analyzed_comments, f, indent=2)
+    with open(output_file, 'wb') as f:
+        f.write(json_dumps(analyzed_comments, indent=True))
 
 @click.command()
 @click.option('--input-file', default='data/comments.json', help='Input JSON file containing comments')
-@click.option('--output-file', default='output/analyzed_comments.json', help='Output file name')
+@click.option('--output-file', default='output/analyzed_comments.json', help='Output file name (.json, or .jsonl to write results as they are analyzed)')
 @click.option('--filter-offensive/--no-filter-offensive', default=False, help='Filter output to only include offensive comments')
 @click.option('--create-plots/--no-create-plots', default=True, help='Create visualization plots')
 @click.option('--plot-format', type=click.Choice(['html', 'png']), default='html', help='Format for visualization plots')
-def main(input_file: str, output_file: str, filter_offensive: bool, create_plots: bool, plot_format: str):
+@click.option('--mode', type=click.Choice(['sync', 'batch']), default='sync', help='Analyze comments with live requests (sync) or the OpenAI Batch API (batch)')
+@click.option('--max-concurrent', type=click.IntRange(min=1), default=20, help='Maximum number of concurrent OpenAI requests')
+@click.option('--batch-size', type=click.IntRange(min=1), default=20, help='Number of comments analyzed per OpenAI request')
+@click.option('--max-requests-per-minute', type=click.IntRange(min=1), default=3500, help='Request rate limit for sync mode')
+@click.option('--max-tokens-per-minute', type=click.IntRange(min=1), default=90000, help='Token rate limit for sync mode')
+@click.option('--use-cache/--no-use-cache', default=True, help='Reuse analyses of previously seen comments')
+@click.option('--cache-dir', default='cache/openai', help='Directory of the analysis cache')
+@click.option('--prefilter', type=click.Choice(['none', 'profanity-skip-clean', 'profanity-only']), default='none', help='Skip OpenAI for comments the profanity check considers clean')
+def main(input_file: str, output_file: str, filter_offensive: bool, create_plots: bool, plot_format: str, mode: str, max_concurrent: int, batch_size: int, max_requests_per_minute: int, max_tokens_per_minute: int, use_cache: bool, cache_dir: str, prefilter: str):
     """Main function to process and analyze comments."""
     # Ensure output directory exists
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
     
-    # Load comments
-    print("Loading comments...")
-    comments = load_comments(input_file)
-    print(f"Loaded {len(comments)} comments")
-    
     # Pre-filter using profanity check
-    profanity.load_censor_words()
+    contains_profanity = build_profanity_checker()
     
-    # Analyze comments
-    print("\nAnalyzing comments...")
-    for comment in comments:
-        # Pre-filter with profanity check
-        comment['contains_profanity'] = profanity.contains_profanity(comment['comment_text'])
-        
-        # Analyze with OpenAI
-        analysis = analyze_comment(comment['comment_text'])
-        comment.update(analysis)
+    # Stream comments from the input; the Batch API gets everything as a single job
+    print("Analyzing comments...")
+    comment_stream = load_comments(input_file)
+    if mode == 'batch':
+        comment_chunks = [list(comment_stream)]
+    else:
+        # Each chunk holds enough comments to keep every concurrent request busy
+        comment_chunks = chunks(comment_stream, max(STREAM_CHUNK_SIZE, max_concurrent * batch_size))
+    
+    if filter_offensive:
+        output_file = output_file.replace('.json', '_offensive.json')
+    
+    # JSON Lines output is written while the analysis runs; JSON is exported at the end,
+    # which needs every comment kept in memory unless only offensive ones are exported
+    stream_output = output_file.endswith('.jsonl')
+    keep_comments = not stream_output and not filter_offensive
+    
+    # Without the on-disk cache, duplicates are still collapsed within this run
+    cache = diskcache.Cache(cache_dir) if use_cache else {}
+    try:
+        with open(output_file, 'wb') if stream_output else contextlib.nullcontext() as stream_file:
+            comments, offensive_comments, columns = asyncio.run(moderate_comments(
+                comment_chunks, contains_profanity, cache, prefilter, mode, max_concurrent, batch_size,
+                max_requests_per_minute, max_tokens_per_minute, stream_file, filter_offensive, keep_comments
+            ))
+    finally:
+        if use_cache:
+            cache.close()
     
     # Generate report
-    report = generate_report(comments)
+    arrays = column_arrays(columns)
+    report = generate_report(arrays, offensive_comments)
     
     # Filter comments if requested
     if filter_offensive:
-        comments = [c for c in comments if c['is_offensive']]
-        output_file = output_file.replace('.json', '_offensive.json')
+        comments = report['all_offensive']
     
     # Export results
-    export_to_json(comments, output_file)
+    if not stream_output:
+        export_to_json(comments, output_file)
     
     # Create visualizations if requested
     if create_plots and report['offense_types']:
         # Create offense type distribution plot
         plot_file = os.path.splitext(output_file)[0] + '_offense_distribution.' + plot_format
-        plot_offense_distribution(report['offense_types'], plot_file)
+        plot_offense_distribution(report['offense_types'], plot_file, plot_format)
         print(f"\nOffense type distribution chart saved as '{plot_file}'")
         
         # Create severity distribution plot
         severity_file = os.path.splitext(output_file)[0] + '_severity_distribution.' + plot_format
-        plot_severity_distribution(comments, severity_file)
+        plot_severity_distribution(report['severity_counts'], severity_file, plot_format)
         print(f"Severity distribution chart saved as '{severity_file}'")
     
     # Print summary
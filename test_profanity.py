@@ -0,0 +1,38 @@
+import json
+import random
+from better_profanity import profanity
+from comment_moderator import build_profanity_checker
+
+FILLER = "the quick brown fox jumps over a lazy dog class assessment shitake hello as is so bit".split()
+SEPARATORS = [" ", ".", "-", "_", ", ", "!"]
+
+def random_texts(count: int, seed: int = 1):
+    """Generate comments mixing filler words with censored words, substituted, split apart and punctuated."""
+    rng = random.Random(seed)
+    words = sorted(str(word) for word in profanity.CENSOR_WORDSET)
+    for _ in range(count):
+        parts = rng.choices(FILLER, k=rng.randint(1, 8))
+        if rng.random() < 0.6:
+            word = rng.choice(words)
+            if rng.random() < 0.5:
+                word = ''.join(rng.choice(profanity.CHARS_MAPPING.get(c, (c,))) for c in word)
+            if rng.random() < 0.3:
+                word = word.upper()
+            if rng.random() < 0.3:
+                # Split the word apart, as in "s.h.i.t" or "f u c k"
+                word = rng.choice(SEPARATORS).join(word)
+            word = rng.choice(["", "'", "."]) + word + rng.choice(["", "s", "!", "x", ".", ".x"])
+            parts.insert(rng.randint(0, len(parts)), word)
+        yield rng.choice(SEPARATORS).join(parts) + rng.choice(["", ".", "!", "?!"])
+
+def test_matches_better_profanity():
+    contains_profanity = build_profanity_checker()
+    with open('data/comments.json') as f:
+        texts = [comment['comment_text'] for comment in json.load(f)['comments']]
+    texts += list(random_texts(3000))
+    mismatches = [text for text in texts if contains_profanity(text) != profanity.contains_profanity(text)]
+    assert not mismatches, mismatches[:10]
+
+if __name__ == "__main__":
+    test_matches_better_profanity()
+    print("Profanity checker matches better_profanity")